@@ -16,23 +16,249 @@ Uses GPT-4o vision with unlimited token analysis for comprehensive diagnosis.
 """
 
 import os
-import json
+import re
+import sys
+import csv
 import base64
+import gzip
+import hashlib
+import io
+import threading
 import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, Optional
-import requests
-from dotenv import load_dotenv
-import pandas as pd
-from bs4 import BeautifulSoup
+from typing import Dict, Any, List, Optional, Tuple
+import orjson
 
+# requests, lxml and PIL are imported where they are first used, so startup
+# stays cheap and worker processes only load what their stage needs.
+# .env is always read (for the DIAGNOSIS_* settings too); values already set
+# in the environment take precedence.
+from dotenv import load_dotenv
 load_dotenv()
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# Number of cases diagnosed concurrently (API calls are network-bound)
+MAX_CONCURRENT_CASES = int(os.getenv('DIAGNOSIS_WORKERS', '4'))
+# Reuse stored API responses for identical inputs (set DIAGNOSIS_CACHE=0 to disable)
+CACHE_ENABLED = os.getenv('DIAGNOSIS_CACHE', '1') != '0'
+CACHE_TTL_SECONDS = int(os.getenv('DIAGNOSIS_CACHE_TTL', str(7 * 24 * 3600)))
+# Gzip request bodies (Content-Encoding: gzip). Off by default - only enable
+# for endpoints/proxies known to accept compressed requests
+GZIP_REQUESTS = os.getenv('DIAGNOSIS_GZIP_REQUESTS', '0') == '1'
 
 SCREENSHOTS_DIR = Path("data/screenshots")
 HTML_DIR = Path("data/html")
 RESULTS_DIR = Path("diagnosis_results")
 RESULTS_DIR.mkdir(exist_ok=True)
+CACHE_DIR = Path("diagnosis_cache")
+
+# Column order of diagnosis_summary.csv (rows from diagnose_screenshot)
+SUMMARY_COLUMNS = [
+    'case', 'status', 'issue_type', 'severity', 'confidence', 'diagnosis',
+    'capture_improvement', 'top_recommendation', 'capture_recommendations_details',
+    'html_element_count', 'is_spa', 'frameworks_detected',
+    'tokens_in', 'tokens_out', 'total_tokens', 'cost', 'processing_time', 'error'
+]
+
+OPENAI_CHAT_URL = 'https://api.openai.com/v1/chat/completions'
+OPENAI_MODEL = 'gpt-4o'
+# 'high' detail fits every image into 2048x2048 and then scales its shortest
+# side down to 768 server-side, so larger screenshots only cost upload time
+VISION_MAX_DIMENSION = 2048
+VISION_SHORT_SIDE = 768
+
+# Static part of the diagnosis prompt: rules, task and output format. It is
+# identical for every case, so it is built once here and diagnose_screenshot
+# only appends the per-case data.
+DIAGNOSIS_PROMPT_RULES = """You are an expert web rendering diagnostician analyzing a screenshot of a web page.
+
+Your task: Determine if this page renders correctly or has rendering issues.
+
+**CRITICAL RULES FOR DETECTING ISSUES:**
+
+1. **Partial Page Loads / Incomplete Rendering (BROKEN)**:
+   - Page shows header/nav but main content area is blank/minimal
+   - Visible loading spinners, "Loading..." text, or skeleton screens
+   - Large white/empty spaces where content should be
+   - Only top 20-30% of expected page is visible
+   - Sign: HTML has <100 elements but screenshot shows minimal content
+
+2. **Overlays Blocking Content (BROKEN)**:
+   - Cookie consent modal covering 50%+ of page WITH no dismiss button visible
+   - Security check overlay (Cloudflare) blocking ALL content
+   - Modal/popup preventing ANY interaction with main content
+   - Sign: User cannot access page without action, but action is impossible
+
+3. **CRITICAL RULES FOR MARKETING PAGES:**
+
+1. **Blog/Marketing Pages with Multiple CTAs = CORRECT**
+   - Hero section at top with subscription form = NORMAL
+   - Footer at bottom with same subscription form = NORMAL MARKETING PATTERN
+   - This is NOT duplication - it's intentional conversion optimization
+   - Status: CORRECT unless other issues present
+
+2. **Blog Article Lists = CORRECT**
+   - Grid/list of blog cards with titles/excerpts = NORMAL
+   - 5-15 similar article cards = STANDARD BLOG LAYOUT
+   - Status: CORRECT unless cards have identical content
+
+3. **Real Duplication Issues (BROKEN)**:
+   - ENTIRE article/section body repeats 2-3x with IDENTICAL text
+   - Same paragraph appearing multiple times in succession
+   - Visual evidence: scroll down and see the exact same large content block (300px+) repeating
+
+**WHAT TO ACTUALLY FLAG AS BROKEN:**
+- **Partial Page Load**: Header visible but main content missing/minimal (especially if HTML has <100 elements)
+- **Incomplete JS Rendering**: Page stuck loading, shows skeleton/placeholder, large empty areas
+- **Overlays Blocking Access**: Modal/overlay covering 50%+ with NO visible close/dismiss button
+- **Massive Content Duplication**: The MAIN BODY content (articles, paragraphs) repeats identically 2-3x
+- **Blocking Modals**: Modal covering 80%+ of page preventing ALL interaction
+- **Blank Pages**: Completely empty, no content at all
+- **Security Blocks**: Full-page Cloudflare "checking your browser" blocking everything
+- **Complete Render Failures**: Broken CSS, unstyled content, major layout collapse
+
+**WHAT IS NORMAL (CORRECT):**
+- Header at top + Footer at bottom with links/CTAs = STANDARD
+- Hero/CTA at page top + same CTA in footer = MARKETING BEST PRACTICE
+- List of blog articles with thumbnails and excerpts = BLOG DESIGN
+- Navigation menu repeated in header and footer = NORMAL
+- "Subscribe" appearing twice (hero + footer) = INTENTIONAL
+
+**YOUR TASK - INTELLIGENT ANALYSIS:**
+You have access to:
+1. The VISUAL screenshot - what the page actually looks like
+2. The HTML STRUCTURE - element counts, frameworks, class patterns, text content
+3. The HTML FILE metadata - total elements, DOM depth, script complexity
+
+Use ALL of this information together to make intelligent decisions:
+- Look at what the screenshot SHOWS visually
+- Cross-reference with HTML structure (e.g., "HTML has 48 elements but screenshot is blank")
+- Identify the ROOT CAUSE (e.g., "Low element count + blank visual = SPA captured too early")
+- Determine the BEST capture strategy for THIS specific page
+
+Do NOT just count things and apply rules. UNDERSTAND what's happening:
+- WHY does this page look this way?
+- WHAT does the HTML tell us about loading behavior?
+- HOW should we capture THIS specific page?
+
+Think like an engineer debugging a capture issue, not a pattern matcher.
+
+**OUTPUT FORMAT (JSON):**
+{
+    "status": "CORRECT" or "BROKEN",
+    "issue_type": "partial_load" | "js_render_failure" | "blocking_overlay" | "duplicate_content" | "blocking_modal" | "security_block" | "blank_page" | "layout_break" | "missing_assets" | "normal_page" | "other",
+    "severity": "critical" | "major" | "minor" | "none",
+    "confidence": 0.0-1.0,
+    "confidence_reasoning": "Explain why you have this confidence level",
+    "visual_description": "Detailed description of what you see in the screenshot",
+    "diagnosis": "Clear explanation of the issue (if any)",
+    "evidence": "Specific visual evidence - measurements, locations, text content seen",
+    "html_correlation": "If HTML data available, explain how structure relates to visual issue",
+    "user_impact": "How this affects user experience",
+    "root_cause": "What likely caused this rendering issue",
+    "capture_improvement": "Analyze the visual evidence + HTML data. What capture strategy would prevent this issue? Be specific and thoughtful.",
+    "capture_recommendations": {
+        "primary_issue": "What is the main capture problem you identified?",
+        "wait_strategy": "What wait approach makes sense? (time-based/selector-based/network-idle/hybrid) - explain why",
+        "wait_duration": "How long to wait? Base this on the specific page characteristics",
+        "selectors_to_wait_for": ["Which specific CSS selectors should we wait for? Suggest realistic ones based on HTML"],
+        "scroll_needed": true/false - "Does this page need scrolling? Why or why not?",
+        "modal_handling": "Are there modals to handle? What's the best approach?",
+        "technical_implementation": "Provide complete working code snippet that solves THIS specific case"
+    }
+}
+
+**CRITICAL**: Return ONLY valid JSON. Ensure all string values are properly escaped:
+- Use \\n for newlines within strings
+- Escape quotes as \\"
+- Do not include actual line breaks in string values
+- All strings must be on a single line or properly escaped
+"""
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+HTML_READ_CHUNK_SIZE = 64 * 1024
+
+# Raw-source markers, matched in a single pass over the HTML
+_HTML_MARKER_RE = re.compile(
+    rb'(?P<next>_next)'
+    rb'|(?P<ajax>fetch\(|XMLHttpRequest|axios|\$\.ajax)'
+    rb'|(?P<cookie>(?i:cookie))'
+)
+# Carried between chunks so a marker split across a boundary is still found
+# (one less than the longest marker, 'XMLHttpRequest')
+_HTML_MARKER_OVERLAP = len('XMLHttpRequest') - 1
+
+# JSON object in the model reply: fenced (```json / ```) or bare
+_JSON_BLOCK_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```|(\{.*\})', re.DOTALL)
+# Quoted JSON string values, used to escape raw newlines the model leaves in them
+_JSON_STRING_RE = re.compile(r'("(?:[^"\\]|\\.)*")')
+
+
+def _get_session():
+    """
+    One keep-alive session for every API call, so the TLS handshake is paid
+    once per run instead of once per case. Retries stay in diagnose_screenshot.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            
+            session = requests.Session()
+            session.headers.update({
+                'Authorization': f'Bearer {OPENAI_API_KEY}',
+                'Content-Type': 'application/json'
+            })
+            # One pooled connection per concurrent case, so no worker waits on
+            # (or discards) a connection
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_CASES))
+            _SESSION = session
+    return _SESSION
+
+
+class _CaseOutput(threading.local):
+    buffer = None
+
+
+class _CaseStdout:
+    """
+    sys.stdout stand-in used while cases run concurrently: inside case_block()
+    a thread's prints are collected and written out as one block when the
+    case is done, so the output of parallel cases never interleaves.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = _CaseOutput()
+        self.lock = threading.Lock()
+    
+    def write(self, text):
+        buffer = self.local.buffer
+        return (buffer if buffer is not None else self.stream).write(text)
+    
+    def flush(self):
+        self.stream.flush()
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+    
+    @contextmanager
+    def case_block(self):
+        self.local.buffer = io.StringIO()
+        try:
+            yield
+        finally:
+            block = self.local.buffer.getvalue()
+            self.local.buffer = None
+            with self.lock:
+                self.stream.write(block)
+                self.stream.flush()
 
 
 def analyze_html_structure(html_path: Path) -> Dict[str, Any]:
@@ -48,26 +274,72 @@ def analyze_html_structure(html_path: Path) -> Dict[str, Any]:
     - JavaScript rendering patterns
     - Capture timing recommendations
     """
+    import lxml.html
+    
     try:
-        with open(html_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
+        # Stream the raw bytes into the parser chunk by chunk so the whole page
+        # is never held (or decoded) as one string; markers are scanned on the
+        # same chunks
+        parser = lxml.html.HTMLParser(encoding='utf-8')
+        html_markers = set()
+        tail = b''
+        has_content = False
+        with open(html_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HTML_READ_CHUNK_SIZE), b''):
+                parser.feed(chunk)
+                has_content = has_content or bool(chunk.strip())
+                if len(html_markers) < 3:
+                    window = tail + chunk
+                    html_markers.update(match.lastgroup for match in _HTML_MARKER_RE.finditer(window))
+                    tail = window[-_HTML_MARKER_OVERLAP:]
+        
+        # An empty or whitespace-only file has no document at all; it is
+        # analyzed as an empty page rather than reported as a failure
+        tree = parser.close() if has_content else None
         
-        soup = BeautifulSoup(html_content, 'html.parser')
+        # Walk the DOM once; every class-pattern query below filters this
+        # index instead of re-traversing the whole tree
+        all_tags = [tag for tag in tree.iter() if isinstance(tag.tag, str)] if tree is not None else []
+        class_tags = [(tag, tag.get('class').lower()) for tag in all_tags if tag.get('class')]
+        
+        def find_by_class(terms, names=None):
+            return [tag for tag, classes in class_tags
+                    if (names is None or tag.tag in names) and any(term in classes for term in terms)]
+        
+        # Calculate DOM depth before anything is stripped from the tree
+        def get_max_depth(element, depth=0):
+            children_with_names = [child for child in element if isinstance(child.tag, str)]
+            if not children_with_names:
+                return depth
+            return max(get_max_depth(child, depth + 1) for child in children_with_names)
+        
+        body = tree.find('body') if tree is not None else None
+        max_depth = get_max_depth(body) if body is not None else 0
+        
+        # Script metadata is read first; scripts and styles are then stripped
+        # so text_content() only returns visible text
+        script_tags = [tag for tag in all_tags if tag.tag == 'script']
+        script_srcs = [tag.get('src', '').lower() for tag in script_tags]
+        total_script_size = sum(len(tag.text or '') for tag in script_tags if not tag.get('src'))
+        for tag in all_tags:
+            if tag.tag in ('script', 'style', 'noscript', 'template'):
+                tag.drop_tree()
+        
+        def visible_text(element):
+            return ' '.join(element.text_content().split())
         
         # Find all major content containers
-        main_sections = soup.find_all(['main', 'article', 'section'], 
-                                     class_=lambda x: x and any(term in str(x).lower() 
-                                     for term in ['content', 'main', 'article', 'section', 'container']))
+        main_sections = find_by_class(['content', 'main', 'article', 'section', 'container'],
+                                      names=('main', 'article', 'section'))
         
         # Detect modals and overlays
-        modals = soup.find_all(['div', 'section'], 
-                              class_=lambda x: x and any(term in str(x).lower() 
-                              for term in ['modal', 'overlay', 'popup', 'cookie', 'consent']))
+        modals = find_by_class(['modal', 'overlay', 'popup', 'cookie', 'consent'],
+                               names=('div', 'section'))
         
         # Extract text content from major sections to detect ACTUAL duplicates
         section_texts = []
         for section in main_sections[:10]:  # Check first 10 major sections
-            text = section.get_text(strip=True)[:500]  # First 500 chars
+            text = visible_text(section)[:500]  # First 500 chars
             if len(text) > 100:  # Only meaningful sections
                 section_texts.append(text)
         
@@ -85,13 +357,9 @@ def analyze_html_structure(html_path: Path) -> Dict[str, Any]:
                 seen[text] = idx
         
         # Find repeated class patterns (but be smarter about it)
-        all_classes = []
-        for tag in soup.find_all(class_=True):
-            all_classes.extend(tag.get('class', []))
-        
-        class_counts = {}
-        for cls in all_classes:
-            class_counts[cls] = class_counts.get(cls, 0) + 1
+        class_counts = Counter()
+        for tag, _ in class_tags:
+            class_counts.update(tag.get('class').split())
         
         # Only flag truly suspicious patterns (high count + semantic meaning)
         suspicious_duplication = []
@@ -104,75 +372,54 @@ def analyze_html_structure(html_path: Path) -> Dict[str, Any]:
                     'note': 'High repetition - check if content is identical'
                 })
         
-        # Calculate DOM depth
-        def get_max_depth(element, depth=0):
-            if not element or not hasattr(element, 'children'):
-                return depth
-            children_with_names = [child for child in element.children if hasattr(child, 'name') and child.name]
-            if not children_with_names:
-                return depth
-            return max(get_max_depth(child, depth + 1) for child in children_with_names)
-        
-        max_depth = get_max_depth(soup.body) if soup.body else 0
-        
         # Detect footer with CTA (normal pattern)
-        footer = soup.find('footer') or soup.find(class_=lambda x: x and 'footer' in str(x).lower())
+        footer = next((tag for tag in all_tags if tag.tag == 'footer'), None)
+        if footer is None:
+            footer = next(iter(find_by_class(['footer'])), None)
         has_footer_cta = False
-        if footer:
-            footer_text = footer.get_text(strip=True).lower()
+        if footer is not None:
+            footer_text = visible_text(footer).lower()
             has_footer_cta = any(term in footer_text for term in ['subscribe', 'sign up', 'newsletter'])
         
         # ==== NEW: ADVANCED CAPTURE ANALYSIS ====
         
         # 1. Detect JavaScript-heavy SPAs (need wait time)
-        script_tags = soup.find_all('script')
         framework_indicators = {
-            'react': any('react' in str(script.get('src', '')).lower() for script in script_tags),
-            'vue': any('vue' in str(script.get('src', '')).lower() for script in script_tags),
-            'angular': any('angular' in str(script.get('src', '')).lower() for script in script_tags),
-            'next': any('next' in str(script.get('src', '')).lower() or '_next' in html_content for script in script_tags),
+            'react': any('react' in src for src in script_srcs),
+            'vue': any('vue' in src for src in script_srcs),
+            'angular': any('angular' in src for src in script_srcs),
+            'next': bool(script_tags) and (any('next' in src for src in script_srcs) or 'next' in html_markers),
         }
         is_spa = any(framework_indicators.values())
         
         # 2. Detect loading indicators (page might not be ready)
-        loading_indicators = soup.find_all(class_=lambda x: x and any(
-            term in str(x).lower() for term in ['loading', 'spinner', 'skeleton', 'placeholder']
-        ))
+        loading_indicators = find_by_class(['loading', 'spinner', 'skeleton', 'placeholder'])
         
         # 3. Detect lazy-loaded content
-        lazy_images = soup.find_all('img', attrs={'loading': 'lazy'}) or \
-                     soup.find_all(attrs={'data-src': True})
+        lazy_images = [tag for tag in all_tags if tag.tag == 'img' and tag.get('loading') == 'lazy'] or \
+                      [tag for tag in all_tags if tag.get('data-src') is not None]
         
         # 4. Detect infinite scroll patterns
-        has_infinite_scroll = bool(soup.find_all(class_=lambda x: x and any(
-            term in str(x).lower() for term in ['infinite', 'load-more', 'pagination']
-        )))
+        has_infinite_scroll = bool(find_by_class(['infinite', 'load-more', 'pagination']))
         
         # 5. Check for dynamic content markers
-        empty_containers = soup.find_all(['div', 'section'], 
-                                        class_=lambda x: x and any(
-                                            term in str(x).lower() for term in 
-                                            ['container', 'content', 'main']
-                                        ))
-        empty_containers_count = sum(1 for c in empty_containers if len(c.get_text(strip=True)) < 50)
+        empty_containers = find_by_class(['container', 'content', 'main'], names=('div', 'section'))
+        empty_containers_count = sum(1 for c in empty_containers if len(visible_text(c)) < 50)
         
         # 6. Analyze script complexity
-        inline_scripts = [s for s in script_tags if not s.get('src')]
-        total_script_size = sum(len(s.string or '') for s in inline_scripts)
         has_heavy_js = total_script_size > 10000 or len(script_tags) > 10
         
         # 7. Check for AJAX/fetch patterns in scripts
-        has_ajax_patterns = 'fetch(' in html_content or 'XMLHttpRequest' in html_content or \
-                           'axios' in html_content or '$.ajax' in html_content
+        has_ajax_patterns = 'ajax' in html_markers
         
         return {
-            'total_elements': len(soup.find_all()),
+            'total_elements': len(all_tags),
             'main_sections_count': len(main_sections),
             'modal_elements_count': len(modals),
             'dom_depth': max_depth,
             'text_content_duplicates': text_duplicates,
             'suspicious_class_patterns': suspicious_duplication[:3],
-            'has_cookie_consent': 'cookie' in html_content.lower(),
+            'has_cookie_consent': 'cookie' in html_markers,
             'has_footer_cta': has_footer_cta,
             'modal_element_ids': [m.get('id', 'no-id') for m in modals[:3]],
             # NEW FIELDS
@@ -195,274 +442,369 @@ def analyze_html_structure(html_path: Path) -> Dict[str, Any]:
         }
 
 
-def diagnose_screenshot(screenshot_path: Path, case_name: str) -> Dict[str, Any]:
+def encode_screenshot(screenshot_path: Path, warnings: Optional[List[str]] = None) -> Tuple[str, str]:
     """
-    Comprehensive visual diagnosis using GPT-4o with unlimited tokens.
+    Load a screenshot for the vision API, returning (base64 data, MIME type).
     
-    Analyzes screenshot to detect ANY type of rendering issue, not limited
-    to predefined patterns. VLM provides deep analysis of visual problems.
+    Screenshots already within the model's input size are sent untouched;
+    larger ones are downscaled to it and re-encoded as JPEG. Problems are
+    appended to `warnings` when given, otherwise printed.
     """
-    print(f"\n{'='*80}")
-    print(f"[*] Analyzing: {case_name}")
-    print(f"{'='*80}")
+    from PIL import Image
     
-    start_time = time.time()
-    
-    # Load high-quality screenshot
-    with open(screenshot_path, 'rb') as f:
-        base64_image = base64.b64encode(f.read()).decode('utf-8')
-    
-    # Analyze HTML structure if available (handle _correct suffix)
-    # Try exact match first, then without _correct suffix
-    html_path = HTML_DIR / f"{case_name}.html"
-    if not html_path.exists() and case_name.endswith('_correct'):
-        # Try without _correct suffix
-        base_name = case_name.rsplit('_correct', 1)[0]
-        html_path = HTML_DIR / f"{base_name}.html"
-    
-    html_analysis = analyze_html_structure(html_path) if html_path.exists() else {}
-    html_file_found = html_path.exists()
-    
-    # Extract key structural elements from HTML for validation
-    html_validation_note = ""
-    if html_analysis and html_analysis.get('total_elements', 0) < 100:
-        html_validation_note = f"\n⚠️ **LOW HTML ELEMENT COUNT ({html_analysis['total_elements']} elements)**: This suggests a JavaScript-rendered SPA (Single Page App). The HTML is just a skeleton - actual content loads via JS. If screenshot shows partial/incomplete content, this is likely a RENDER FAILURE or JS ERROR."
-    
-    # Universal diagnostic prompt - handles ANY rendering issue
-    # Special handling for marketing pages with footer CTAs
-    marketing_context = ""
-    if html_analysis.get('has_footer_cta'):
-        marketing_context = "\n**IMPORTANT**: HTML indicates this is a marketing page with a footer CTA. Having the same subscription form at the top AND bottom of the page is a STANDARD MARKETING PATTERN, not a bug."
+    try:
+        with Image.open(screenshot_path) as img:
+            width, height = img.size
+            scale = min(1.0, VISION_MAX_DIMENSION / max(width, height))
+            scale *= min(1.0, VISION_SHORT_SIDE / (min(width, height) * scale))
+            if scale == 1.0:
+                with open(screenshot_path, 'rb') as f:
+                    return base64.b64encode(f.read()).decode('utf-8'), Image.MIME.get(img.format, 'image/png')
+            
+            target_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            # JPEG sources decode at reduced size in the DCT domain (no-op for PNG);
+            # reducing_gap then shrinks by an integer factor with a cheap box filter
+            # before the final Lanczos pass
+            img.draft('RGB', target_size)
+            # Convert to RGB before resizing: resize falls back to NEAREST for
+            # palette and 1-bit images, and transparent areas are flattened
+            # onto white instead of turning black in the JPEG
+            if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+                flattened = Image.new('RGBA', img.size, (255, 255, 255, 255))
+                flattened.alpha_composite(img.convert('RGBA'))
+                img = flattened
+            img = img.convert('RGB')
+            img = img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=75)
+    except (OSError, Image.DecompressionBombError) as e:
+        # Unreadable, truncated or oversized image (UnidentifiedImageError is
+        # an OSError): send the file as-is, as before resizing existed, and let the API judge it
+        warning = f"Could not decode {screenshot_path.name} ({str(e)}), sending it unchanged"
+        if warnings is not None:
+            warnings.append(warning)
+        else:
+            print(f"   [!] {warning}")
+        with open(screenshot_path, 'rb') as f:
+            return base64.b64encode(f.read()).decode('utf-8'), 'image/png'
     
-    prompt = f"""You are an expert web rendering diagnostician analyzing a screenshot of a web page.
+    return base64.b64encode(buffer.getvalue()).decode('utf-8'), 'image/jpeg'
 
-Your task: Determine if this page renders correctly or has rendering issues.
 
-**HTML STRUCTURE VALIDATION:**{html_validation_note}
+def response_cache_key(model: str, prompt: str, image_base64: str) -> str:
+    """Hash everything the API sees, so only byte-identical requests share a key."""
+    digest = hashlib.sha256()
+    for part in (model, prompt, image_base64):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
 
-**CRITICAL RULES FOR DETECTING ISSUES:**
 
-1. **Partial Page Loads / Incomplete Rendering (BROKEN)**:
-   - Page shows header/nav but main content area is blank/minimal
-   - Visible loading spinners, "Loading..." text, or skeleton screens
-   - Large white/empty spaces where content should be
-   - Only top 20-30% of expected page is visible
-   - Sign: HTML has <100 elements but screenshot shows minimal content
+def load_cached_response(key: str) -> Optional[Dict[str, Any]]:
+    """Return the stored API response for this key, or None if missing or expired."""
+    cache_path = CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - cache_path.stat().st_mtime > CACHE_TTL_SECONDS:
+            return None
+        with open(cache_path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
 
-2. **Overlays Blocking Content (BROKEN)**:
-   - Cookie consent modal covering 50%+ of page WITH no dismiss button visible
-   - Security check overlay (Cloudflare) blocking ALL content
-   - Modal/popup preventing ANY interaction with main content
-   - Sign: User cannot access page without action, but action is impossible
 
-3. **CRITICAL RULES FOR MARKETING PAGES:**
+def store_cached_response(key: str, data: Dict[str, Any]) -> None:
+    """Persist an API response; written to a temp file first so readers never see partial JSON."""
+    CACHE_DIR.mkdir(exist_ok=True)
+    cache_path = CACHE_DIR / f"{key}.json"
+    # Unique per process and thread: concurrent cases with identical input
+    # store the same key at the same time
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"   [!] Could not write response cache: {str(e)}")
 
-1. **Blog/Marketing Pages with Multiple CTAs = CORRECT**
-   - Hero section at top with subscription form = NORMAL
-   - Footer at bottom with same subscription form = NORMAL MARKETING PATTERN
-   - This is NOT duplication - it's intentional conversion optimization
-   - Status: CORRECT unless other issues present
 
-2. **Blog Article Lists = CORRECT**
-   - Grid/list of blog cards with titles/excerpts = NORMAL
-   - 5-15 similar article cards = STANDARD BLOG LAYOUT
-   - Status: CORRECT unless cards have identical content
+def list_html_files() -> Dict[str, Path]:
+    """
+    List the HTML directory as a stem -> path mapping for find_html_path().
+    
+    Every file is keyed by its exact stem and, unless that key is already
+    taken, by its lowercased stem as well, so an exact match always wins and
+    a case-insensitive one is the fallback.
+    """
+    html_paths = sorted(path for path in HTML_DIR.glob("*") if path.suffix.lower() == '.html')
+    html_files = {path.stem: path for path in html_paths}
+    for path in html_paths:
+        html_files.setdefault(path.stem.lower(), path)
+    return html_files
 
-3. **Real Duplication Issues (BROKEN)**:
-   - ENTIRE article/section body repeats 2-3x with IDENTICAL text
-   - Same paragraph appearing multiple times in succession
-   - Visual evidence: scroll down and see the exact same large content block (300px+) repeating
 
-**WHAT TO ACTUALLY FLAG AS BROKEN:**
-- **Partial Page Load**: Header visible but main content missing/minimal (especially if HTML has <100 elements)
-- **Incomplete JS Rendering**: Page stuck loading, shows skeleton/placeholder, large empty areas
-- **Overlays Blocking Access**: Modal/overlay covering 50%+ with NO visible close/dismiss button
-- **Massive Content Duplication**: The MAIN BODY content (articles, paragraphs) repeats identically 2-3x
-- **Blocking Modals**: Modal covering 80%+ of page preventing ALL interaction
-- **Blank Pages**: Completely empty, no content at all
-- **Security Blocks**: Full-page Cloudflare "checking your browser" blocking everything
-- **Complete Render Failures**: Broken CSS, unstyled content, major layout collapse
-
-**WHAT IS NORMAL (CORRECT):**
-- Header at top + Footer at bottom with links/CTAs = STANDARD
-- Hero/CTA at page top + same CTA in footer = MARKETING BEST PRACTICE
-- List of blog articles with thumbnails and excerpts = BLOG DESIGN
-- Navigation menu repeated in header and footer = NORMAL
-- "Subscribe" appearing twice (hero + footer) = INTENTIONAL{marketing_context}
+def find_html_path(case_name: str, html_files: Optional[Dict[str, Path]] = None) -> Optional[Path]:
+    """
+    Locate the HTML file for a case, or None if there is none.
+    
+    Names are matched exactly first, then case-insensitively (like a file
+    check on Windows/macOS). `html_files` is the list_html_files() mapping
+    built once per run; without it the exact name is checked on disk and
+    the directory is only listed when that misses.
+    """
+    # Try exact match first, then without _correct suffix
+    candidates = [case_name]
+    if case_name.endswith('_correct'):
+        candidates.append(case_name.rsplit('_correct', 1)[0])
+    
+    for name in candidates:
+        if html_files is not None:
+            html_path = html_files.get(name) or html_files.get(name.lower())
+        else:
+            html_path = HTML_DIR / f"{name}.html"
+            if not html_path.exists():
+                html_path = list_html_files().get(name.lower())
+        if html_path is not None:
+            return html_path
+    return None
 
-**HTML ANALYSIS (if available):**
-{json.dumps(html_analysis, indent=2) if html_analysis else 'No HTML data available'}
 
-**TEXT CONTENT DUPLICATION CHECK:**
-{'✅ HTML analysis found text content duplicates - check if MAIN BODY repeats' if html_analysis.get('text_content_duplicates') else '✅ No text content duplication detected in HTML'}
+def prepare_case(screenshot_path: Path, case_name: str,
+                 html_files: Optional[Dict[str, Path]] = None) -> Dict[str, Any]:
+    """
+    CPU-bound preparation for one case: screenshot encoding and HTML analysis.
+    
+    Kept apart from the API call so main() can run it in worker processes
+    while other cases are waiting on the network.
+    """
+    start_time = time.time()
+    
+    # Load screenshot at the resolution the vision model will use; warnings
+    # are returned rather than printed, since this may run in a worker process
+    warnings = []
+    base64_image, image_mime = encode_screenshot(screenshot_path, warnings)
+    
+    # Analyze HTML structure if available (handle _correct suffix)
+    html_path = find_html_path(case_name, html_files)
+    html_analysis = analyze_html_structure(html_path) if html_path else {}
+    
+    return {
+        'base64_image': base64_image,
+        'image_mime': image_mime,
+        'html_analysis': html_analysis,
+        'warnings': warnings,
+        'prepare_time': time.time() - start_time
+    }
 
-**HTML ANALYSIS DATA:**
-{json.dumps(html_analysis, indent=2) if html_analysis else 'No HTML data available'}
 
-**YOUR TASK - INTELLIGENT ANALYSIS:**
-You have access to:
-1. The VISUAL screenshot - what the page actually looks like
-2. The HTML STRUCTURE - element counts, frameworks, class patterns, text content
-3. The HTML FILE metadata - total elements, DOM depth, script complexity
+def save_case_result(case_result: Dict[str, Any], json_path: Path) -> None:
+    """Write one case's detailed JSON report."""
+    with open(json_path, 'wb') as f:
+        f.write(orjson.dumps(case_result, option=orjson.OPT_INDENT_2))
 
-Use ALL of this information together to make intelligent decisions:
-- Look at what the screenshot SHOWS visually
-- Cross-reference with HTML structure (e.g., "HTML has 48 elements but screenshot is blank")
-- Identify the ROOT CAUSE (e.g., "Low element count + blank visual = SPA captured too early")
-- Determine the BEST capture strategy for THIS specific page
 
-Do NOT just count things and apply rules. UNDERSTAND what's happening:
-- WHY does this page look this way?
-- WHAT does the HTML tell us about loading behavior?
-- HOW should we capture THIS specific page?
+def report_save_failure(json_path: Path, future) -> None:
+    """Done-callback for a background save: report any error it raised."""
+    error = future.exception()
+    if error is not None:
+        print(f"   [!] Could not save {json_path}: {str(error)}")
 
-Think like an engineer debugging a capture issue, not a pattern matcher.
 
-**OUTPUT FORMAT (JSON):**
-{{
-    "status": "CORRECT" or "BROKEN",
-    "issue_type": "partial_load" | "js_render_failure" | "blocking_overlay" | "duplicate_content" | "blocking_modal" | "security_block" | "blank_page" | "layout_break" | "missing_assets" | "normal_page" | "other",
-    "severity": "critical" | "major" | "minor" | "none",
-    "confidence": 0.0-1.0,
-    "confidence_reasoning": "Explain why you have this confidence level",
-    "visual_description": "Detailed description of what you see in the screenshot",
-    "diagnosis": "Clear explanation of the issue (if any)",
-    "evidence": "Specific visual evidence - measurements, locations, text content seen",
-    "html_correlation": "If HTML data available, explain how structure relates to visual issue",
-    "user_impact": "How this affects user experience",
-    "root_cause": "What likely caused this rendering issue",
-    "capture_improvement": "Analyze the visual evidence + HTML data. What capture strategy would prevent this issue? Be specific and thoughtful.",
-    "capture_recommendations": {{
-        "primary_issue": "What is the main capture problem you identified?",
-        "wait_strategy": "What wait approach makes sense? (time-based/selector-based/network-idle/hybrid) - explain why",
-        "wait_duration": "How long to wait? Base this on the specific page characteristics",
-        "selectors_to_wait_for": ["Which specific CSS selectors should we wait for? Suggest realistic ones based on HTML"],
-        "scroll_needed": true/false - "Does this page need scrolling? Why or why not?",
-        "modal_handling": "Are there modals to handle? What's the best approach?",
-        "technical_implementation": "Provide complete working code snippet that solves THIS specific case"
-    }}
-}}
-
-**CRITICAL**: Return ONLY valid JSON. Ensure all string values are properly escaped:
-- Use \\n for newlines within strings
-- Escape quotes as \\"
-- Do not include actual line breaks in string values
-- All strings must be on a single line or properly escaped
-
-Provide thorough, detailed analysis."""
+def diagnose_screenshot(screenshot_path: Path, case_name: str,
+                        prepared: Optional[Dict[str, Any]] = None,
+                        result_writer: Optional[Executor] = None) -> Dict[str, Any]:
+    """
+    Comprehensive visual diagnosis using GPT-4o with unlimited tokens.
+    
+    Analyzes screenshot to detect ANY type of rendering issue, not limited
+    to predefined patterns. VLM provides deep analysis of visual problems.
+    
+    `prepared` is the prepare_case() output when it was computed ahead of
+    time; otherwise the case is prepared inline. With a `result_writer`
+    executor the per-case JSON is written in the background.
+    """
+    print(f"\n{'='*80}")
+    print(f"[*] Analyzing: {case_name}")
+    print(f"{'='*80}")
+    
+    if prepared is None:
+        prepared = prepare_case(screenshot_path, case_name)
+    for warning in prepared['warnings']:
+        print(f"   [!] {warning}")
+    # Preparation time still counts toward the case's processing time
+    start_time = time.time() - prepared['prepare_time']
+    
+    base64_image = prepared['base64_image']
+    image_mime = prepared['image_mime']
+    html_analysis = prepared['html_analysis']
+    html_analysis_json = orjson.dumps(html_analysis, option=orjson.OPT_INDENT_2).decode('utf-8') if html_analysis else 'No HTML data available'
+    
+    # Extract key structural elements from HTML for validation
+    html_validation_note = ""
+    if html_analysis and html_analysis.get('total_elements', 0) < 100:
+        html_validation_note = f"\n⚠️ **LOW HTML ELEMENT COUNT ({html_analysis['total_elements']} elements)**: This suggests a JavaScript-rendered SPA (Single Page App). The HTML is just a skeleton - actual content loads via JS. If screenshot shows partial/incomplete content, this is likely a RENDER FAILURE or JS ERROR."
+    
+    # Universal diagnostic prompt - handles ANY rendering issue
+    # Special handling for marketing pages with footer CTAs
+    marketing_context = ""
+    if html_analysis.get('has_footer_cta'):
+        marketing_context = "\n**IMPORTANT**: HTML indicates this is a marketing page with a footer CTA. Having the same subscription form at the top AND bottom of the page is a STANDARD MARKETING PATTERN, not a bug."
+    
+    duplication_note = '✅ No text content duplication detected in HTML'
+    if html_analysis.get('text_content_duplicates'):
+        duplication_note = '✅ HTML analysis found text content duplicates - check if MAIN BODY repeats'
+    
+    # DIAGNOSIS_PROMPT_RULES comes first and per-case data last, so every case
+    # shares an identical prompt prefix that the API can serve from its
+    # prompt cache instead of reprocessing it
+    prompt = "\n".join([
+        DIAGNOSIS_PROMPT_RULES,
+        f"**HTML STRUCTURE VALIDATION:**{html_validation_note}{marketing_context}",
+        "",
+        "**HTML ANALYSIS DATA:**",
+        html_analysis_json,
+        "",
+        "**TEXT CONTENT DUPLICATION CHECK:**",
+        duplication_note,
+        "",
+        "Provide thorough, detailed analysis."
+    ])
 
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            print(f"[API] Analyzing with GPT-4o vision model... {'(retry ' + str(attempt + 1) + ')' if attempt > 0 else ''}")
-            
-            response = requests.post(
-                'https://api.openai.com/v1/chat/completions',
-                headers={
-                    'Authorization': f'Bearer {OPENAI_API_KEY}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'model': 'gpt-4o',
-                    'messages': [{
-                        'role': 'user',
-                        'content': [
-                            {'type': 'text', 'text': prompt},
-                            {
-                                'type': 'image_url',
-                                'image_url': {
-                                    'url': f'data:image/png;base64,{base64_image}',
-                                    'detail': 'high'
-                                }
-                            }
-                        ]
-                    }],
-                    # NO max_tokens limit - allow unlimited analysis
-                    'temperature': 0.1
-                },
-                timeout=180  # Longer timeout for detailed analysis
-            )
-            
-            if response.status_code != 200:
-                error_msg = f'API error: {response.status_code} - {response.text}'
+    # The same prompt + screenshot gives the same analysis (temperature 0.1),
+    # so skip the API entirely when this exact input was diagnosed before
+    cache_key = response_cache_key(OPENAI_MODEL, prompt, base64_image)
+    data = load_cached_response(cache_key) if CACHE_ENABLED else None
+    from_cache = data is not None
+    if from_cache:
+        print(f"[CACHE] Reusing cached analysis for identical input")
+    else:
+        import requests
+        
+        # Serialize the request once; retries resend the same bytes
+        request_body = orjson.dumps({
+            'model': OPENAI_MODEL,
+            'messages': [{
+                'role': 'user',
+                'content': [
+                    {'type': 'text', 'text': prompt},
+                    {
+                        'type': 'image_url',
+                        'image_url': {
+                            'url': f'data:{image_mime};base64,{base64_image}',
+                            'detail': 'high'
+                        }
+                    }
+                ]
+            }],
+            # NO max_tokens limit - allow unlimited analysis
+            'temperature': 0.1
+        })
+        request_headers = {}
+        if GZIP_REQUESTS:
+            request_body = gzip.compress(request_body, compresslevel=6)
+            request_headers['Content-Encoding'] = 'gzip'
+        
+        # Prepare the request once (headers, body length) and resend the same
+        # object on retries; environment proxy/CA settings that Session.post
+        # would merge on every call are resolved once as well
+        session = _get_session()
+        prepared_request = session.prepare_request(
+            requests.Request('POST', OPENAI_CHAT_URL, data=request_body, headers=request_headers)
+        )
+        send_settings = session.merge_environment_settings(prepared_request.url, {}, None, None, None)
+        
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                print(f"[API] Analyzing with GPT-4o vision model... {'(retry ' + str(attempt + 1) + ')' if attempt > 0 else ''}")
+                
+                response = session.send(
+                    prepared_request,
+                    timeout=180,  # Longer timeout for detailed analysis
+                    **send_settings
+                )
+                
+                if response.status_code != 200:
+                    error_msg = f'API error: {response.status_code} - {response.text}'
+                    if attempt < max_retries - 1:
+                        print(f"   [!] {error_msg}, retrying...")
+                        time.sleep(2 ** attempt)
+                        continue
+                    else:
+                        return {
+                            'case': case_name,
+                            'status': 'ERROR',
+                            'error': error_msg,
+                            'processing_time': time.time() - start_time
+                        }
+                
+                break
+                
+            except requests.exceptions.Timeout:
                 if attempt < max_retries - 1:
-                    print(f"   [!] {error_msg}, retrying...")
+                    print(f"   [!] Timeout, retrying...")
                     time.sleep(2 ** attempt)
                     continue
                 else:
                     return {
                         'case': case_name,
                         'status': 'ERROR',
-                        'error': error_msg,
+                        'error': 'Timeout after retries',
                         'processing_time': time.time() - start_time
                     }
-            
-            break
-            
-        except requests.exceptions.Timeout:
-            if attempt < max_retries - 1:
-                print(f"   [!] Timeout, retrying...")
-                time.sleep(2 ** attempt)
-                continue
-            else:
-                return {
-                    'case': case_name,
-                    'status': 'ERROR',
-                    'error': 'Timeout after retries',
-                    'processing_time': time.time() - start_time
-                }
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"   [!] Error: {str(e)}, retrying...")
-                time.sleep(2 ** attempt)
-                continue
-            else:
-                return {
-                    'case': case_name,
-                    'status': 'ERROR',
-                    'error': str(e),
-                    'processing_time': time.time() - start_time
-                }
-    
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    print(f"   [!] Error: {str(e)}, retrying...")
+                    time.sleep(2 ** attempt)
+                    continue
+                else:
+                    return {
+                        'case': case_name,
+                        'status': 'ERROR',
+                        'error': str(e),
+                        'processing_time': time.time() - start_time
+                    }
+        
     # Parse response
     try:
-        data = response.json()
-        usage = data.get('usage', {})
+        if not from_cache:
+            data = orjson.loads(response.content)
+        # A cache hit costs nothing, so it reports no token usage
+        usage = {} if from_cache else data.get('usage', {})
         tokens_in = usage.get('prompt_tokens', 0)
         tokens_out = usage.get('completion_tokens', 0)
+        # Input tokens served from the API's prompt cache (shared static prefix)
+        tokens_cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
         total_tokens = tokens_in + tokens_out
         
-        # Cost calculation (GPT-4o pricing)
-        cost = (tokens_in * 2.50 + tokens_out * 10.00) / 1_000_000
+        # Cost calculation (GPT-4o pricing, cached input billed at half rate)
+        cost = ((tokens_in - tokens_cached) * 2.50 + tokens_cached * 1.25 + tokens_out * 10.00) / 1_000_000
         
         # Parse VLM response
         content = data['choices'][0]['message']['content']
         
         # Extract JSON
-        if '```json' in content:
-            content = content.split('```json')[1].split('```')[0].strip()
-        elif '```' in content:
-            content = content.split('```')[1].split('```')[0].strip()
+        json_match = _JSON_BLOCK_RE.search(content)
+        if json_match:
+            content = json_match.group(1) or json_match.group(2)
         
         # Try to parse JSON, handle malformed responses
         try:
-            result = json.loads(content)
-        except json.JSONDecodeError as e:
+            result = orjson.loads(content)
+        except orjson.JSONDecodeError as e:
             # VLM sometimes includes unescaped newlines in strings
             # Try to fix common issues
             print(f"   [!] JSON parse issue, attempting repair...")
             
             # Replace unescaped newlines within strings
-            import re
             # Find all string values and escape newlines within them
-            content_fixed = re.sub(r'("(?:[^"\\]|\\.)*")', lambda m: m.group(0).replace('\n', '\\n'), content)
+            content_fixed = _JSON_STRING_RE.sub(lambda m: m.group(0).replace('\n', '\\n'), content)
             
             try:
-                result = json.loads(content_fixed)
+                result = orjson.loads(content_fixed)
                 print(f"   [OK] JSON repaired successfully")
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 # Last resort: ask VLM to regenerate with proper escaping
-                raise json.JSONDecodeError(f"Could not parse VLM response even after repair. Original error: {e}", content, e.pos)
+                raise orjson.JSONDecodeError(f"Could not parse VLM response even after repair. Original error: {e}", content, e.pos)
         
         processing_time = time.time() - start_time
         
@@ -491,7 +833,7 @@ Provide thorough, detailed analysis."""
             print(f"\n[VLM] Detailed Recommendation: {result['capture_improvement'][:250]}...")
         
         print(f"\n[METRICS] Token Usage:")
-        print(f"   Input Tokens: {tokens_in:,}")
+        print(f"   Input Tokens: {tokens_in:,} ({tokens_cached:,} cached)")
         print(f"   Output Tokens: {tokens_out:,}")
         print(f"   Total Tokens: {total_tokens:,}")
         print(f"   Cost: ${cost:.4f}")
@@ -519,18 +861,34 @@ Provide thorough, detailed analysis."""
             'capture_recommendations': result.get('capture_recommendations', {}),
             'metrics': {
                 'tokens_input': tokens_in,
+                'tokens_cached': tokens_cached,
                 'tokens_output': tokens_out,
                 'tokens_total': total_tokens,
                 'cost_usd': cost,
-                'processing_time_seconds': processing_time
+                'processing_time_seconds': processing_time,
+                'from_cache': from_cache
             }
         }
         
+        # Cache only a reply that produced a complete result; a malformed one
+        # must not be replayed for the whole TTL
+        if CACHE_ENABLED and not from_cache:
+            store_cached_response(cache_key, data)
+        
         # Save individual JSON file
         json_path = RESULTS_DIR / f"{case_name}.json"
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(case_result, f, indent=2, ensure_ascii=False)
-        print(f"   [SAVED] {json_path}")
+        if result_writer is not None:
+            # Reported here so it stays in this case's output; the writer
+            # thread only prints if the write fails
+            save_future = result_writer.submit(save_case_result, case_result, json_path)
+            save_future.add_done_callback(partial(report_save_failure, json_path))
+            print(f"   [SAVING] {json_path}")
+        else:
+            try:
+                save_case_result(case_result, json_path)
+                print(f"   [SAVED] {json_path}")
+            except OSError as e:
+                print(f"   [!] Could not save {json_path}: {str(e)}")
         
         # Format capture recommendations for CSV from VLM response
         capture_rec_text = ""
@@ -592,28 +950,76 @@ def main():
     
     print(f"Found {len(screenshots)} screenshots to analyze\n")
     
-    # Process each screenshot
-    results = []
-    for i, screenshot_path in enumerate(screenshots, 1):
-        case_name = screenshot_path.stem
-        
-        print(f"\n{'='*80}")
-        print(f"[{i}/{len(screenshots)}]")
-        result = diagnose_screenshot(screenshot_path, case_name)
-        results.append(result)
+    # List the HTML directory once instead of stat'ing candidates per case
+    html_files = list_html_files()
     
-    # Save summary CSV (with retry if file is locked)
-    df = pd.DataFrame(results)
-    csv_path = RESULTS_DIR / "diagnosis_summary.csv"
+    # Screenshot encoding and HTML analysis (CPU) run on worker processes
+    # a few cases ahead, so they overlap with the API calls (IO) running
+    # concurrently on threads. Results keep the screenshot order.
+    def run_case(index, screenshot_path, prepared_case):
+        with case_output.case_block():
+            print(f"\n{'='*80}")
+            print(f"[{index}/{len(screenshots)}]")
+            try:
+                prepared = prepared_case.result()
+            except Exception as e:
+                # One unreadable case must not abort the run
+                print(f"[ERROR] Preparation failed: {str(e)}")
+                return {
+                    'case': screenshot_path.stem,
+                    'status': 'ERROR',
+                    'error': f'Preparation failed: {str(e)}',
+                    'processing_time': 0
+                }
+            return diagnose_screenshot(screenshot_path, screenshot_path.stem, prepared, result_writer)
     
+    # Open summary CSV (with retry if file is locked)
+    csv_path = RESULTS_DIR / "diagnosis_summary.csv"
     try:
-        df.to_csv(csv_path, index=False)
+        csv_file = open(csv_path, 'w', newline='', encoding='utf-8')
     except PermissionError:
         # File is open in another program, try alternative name
         timestamp = time.strftime('%Y%m%d_%H%M%S')
         csv_path = RESULTS_DIR / f"diagnosis_summary_{timestamp}.csv"
-        df.to_csv(csv_path, index=False)
-        print(f"\n[!] Note: Original CSV was locked, saved as {csv_path.name}")
+        csv_file = open(csv_path, 'w', newline='', encoding='utf-8')
+        print(f"\n[!] Note: Original CSV was locked, saving as {csv_path.name}")
+    
+    results = []
+    run_start = time.time()
+    # Cases print into per-thread buffers (see _CaseStdout) while they run
+    sys.stdout = case_output = _CaseStdout(sys.stdout)
+    try:
+        # Per-case JSON files are written on a separate thread pool, off the API
+        # workers' path; it is shut down (and drained) after the workers finish
+        with csv_file, ProcessPoolExecutor() as prepare_pool, \
+                ThreadPoolExecutor(max_workers=2) as result_writer, \
+                ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CASES) as executor:
+            summary_writer = csv.DictWriter(csv_file, fieldnames=SUMMARY_COLUMNS, extrasaction='ignore')
+            summary_writer.writeheader()
+            
+            def record(result):
+                # Rows go to disk in screenshot order, each as soon as its case and
+                # all earlier ones have finished, so a long run never buffers the
+                # whole table and an aborted one keeps the rows written so far
+                summary_writer.writerow(result)
+                csv_file.flush()
+                results.append(result)
+            
+            # Only a window of cases is prepared or in flight at a time, so just
+            # their encoded screenshots are held in memory; a case's futures
+            # are dropped as soon as its row is recorded
+            case_window = MAX_CONCURRENT_CASES * 2
+            pending_cases = deque()
+            for index, screenshot_path in enumerate(screenshots, 1):
+                prepared_case = prepare_pool.submit(prepare_case, screenshot_path, screenshot_path.stem, html_files)
+                pending_cases.append(executor.submit(run_case, index, screenshot_path, prepared_case))
+                if len(pending_cases) >= case_window:
+                    record(pending_cases.popleft().result())
+            while pending_cases:
+                record(pending_cases.popleft().result())
+    finally:
+        sys.stdout = case_output.stream
+    run_time = time.time() - run_start
     
     # Calculate statistics
     total_cases = len(results)
@@ -663,10 +1069,12 @@ def main():
     print(f"   Average Cost/Case: ${avg_cost:.4f}")
     
     # Performance
-    total_time = sum(r.get('processing_time', 0) for r in results)
-    avg_time = total_time / len(results) if results else 0
+    # Cases overlap, so the run's wall time is reported rather than the sum
+    # of per-case times
+    total_case_time = sum(r.get('processing_time', 0) for r in results)
+    avg_time = total_case_time / len(results) if results else 0
     print(f"\n⏱️  Performance:")
-    print(f"   Total Time: {total_time:.1f}s")
+    print(f"   Total Time: {run_time:.1f}s")
     print(f"   Average Time/Case: {avg_time:.1f}s")
     
     print(f"\n📁 Results saved to:")